@@ -0,0 +1,218 @@
+"""CUDA kernels for applying the movement rules to a flock on the GPU."""
+
+import math
+
+import numpy as np
+from numba import cuda, float32
+
+# The number of threads per block. Each block loads the positions and
+# velocities of this many boids into shared memory at a time.
+THREADS_PER_BLOCK = 128
+
+
+@cuda.jit(fastmath=True)
+def _step_kernel(
+    pos,
+    vel,
+    out_pos,
+    out_vel,
+    sight_range_sq,
+    min_separation_sq,
+    alignment,
+    cohesion,
+    separation,
+    max_speed,
+    boundary_force,
+    half_width,
+    half_height,
+    target_pos,
+    target_start,
+    target_affinity,
+):
+    """Apply the rules to the boid for this thread. The other boids are
+    loaded into shared memory one tile at a time, so every block reads
+    each boid from global memory only once."""
+
+    tile_pos = cuda.shared.array((THREADS_PER_BLOCK, 2), float32)
+    tile_vel = cuda.shared.array((THREADS_PER_BLOCK, 2), float32)
+
+    i = cuda.grid(1)
+    n = pos.shape[0]
+    active = i < n
+
+    x = 0.0
+    y = 0.0
+    if active:
+        x = pos[i, 0]
+        y = pos[i, 1]
+
+    sum_vx = 0.0
+    sum_vy = 0.0
+    sum_x = 0.0
+    sum_y = 0.0
+    num_neighbors = 0
+    sep_x = 0.0
+    sep_y = 0.0
+
+    for tile_start in range(0, n, THREADS_PER_BLOCK):
+        # Every thread in the block loads one boid of the tile, including
+        # the threads past the end of the flock, so they all reach the
+        # barriers.
+        j = tile_start + cuda.threadIdx.x
+        if j < n:
+            tile_pos[cuda.threadIdx.x, 0] = pos[j, 0]
+            tile_pos[cuda.threadIdx.x, 1] = pos[j, 1]
+            tile_vel[cuda.threadIdx.x, 0] = vel[j, 0]
+            tile_vel[cuda.threadIdx.x, 1] = vel[j, 1]
+        cuda.syncthreads()
+
+        if active:
+            for k in range(min(THREADS_PER_BLOCK, n - tile_start)):
+                if tile_start + k == i:
+                    continue
+
+                dx = tile_pos[k, 0] - x
+                dy = tile_pos[k, 1] - y
+                dist_sq = dx * dx + dy * dy
+
+                if dist_sq <= sight_range_sq:
+                    sum_vx += tile_vel[k, 0]
+                    sum_vy += tile_vel[k, 1]
+                    sum_x += tile_pos[k, 0]
+                    sum_y += tile_pos[k, 1]
+                    num_neighbors += 1
+
+                if dist_sq < min_separation_sq:
+                    sep_x -= dx
+                    sep_y -= dy
+        cuda.syncthreads()
+
+    if not active:
+        return
+
+    vx = vel[i, 0]
+    vy = vel[i, 1]
+
+    # Align the boid's velocity with the sum of the neighbor velocities.
+    new_vx = vx + (sum_vx - vx) * alignment
+    new_vy = vy + (sum_vy - vy) * alignment
+
+    # Steer the boid towards the center of its neighbors, if it has any.
+    if num_neighbors > 0:
+        new_vx += (sum_x / num_neighbors - x) * cohesion
+        new_vy += (sum_y / num_neighbors - y) * cohesion
+
+    # Steer the boid away from the neighbors that are too close.
+    new_vx += sep_x * separation
+    new_vy += sep_y * separation
+
+    # Pursue or flee from the closest boid in each target flock, but only
+    # if the boid can see it.
+    for t in range(target_affinity.shape[0]):
+        closest = -1
+        closest_dist_sq = sight_range_sq
+        for j in range(target_start[t], target_start[t + 1]):
+            dx = target_pos[j, 0] - x
+            dy = target_pos[j, 1] - y
+            dist_sq = dx * dx + dy * dy
+            if dist_sq < closest_dist_sq or (
+                closest < 0 and dist_sq == closest_dist_sq
+            ):
+                closest = j
+                closest_dist_sq = dist_sq
+
+        if closest >= 0:
+            new_vx += (target_pos[closest, 0] - x) * target_affinity[t]
+            new_vy += (target_pos[closest, 1] - y) * target_affinity[t]
+
+    # If the boid is too fast, set the speed to the max speed but preserve
+    # the direction.
+    speed = math.hypot(new_vx, new_vy)
+    if speed > max_speed:
+        new_vx = new_vx / speed * max_speed
+        new_vy = new_vy / speed * max_speed
+
+    # Turn the boid back if it strays outside the window, which spans from
+    # -half_width to half_width and -half_height to half_height.
+    magnitude_sq = new_vx * new_vx + new_vy * new_vy
+
+    if x < -half_width:
+        new_vx += boundary_force
+    elif x > half_width:
+        new_vx -= boundary_force
+
+    if y < -half_height:
+        new_vy += boundary_force
+    elif y > half_height:
+        new_vy -= boundary_force
+
+    # If the velocity correction made the boid speed up, set the speed to
+    # the previous value while keeping the new direction.
+    new_magnitude_sq = new_vx * new_vx + new_vy * new_vy
+    if new_magnitude_sq > magnitude_sq:
+        scale = math.sqrt(magnitude_sq / new_magnitude_sq)
+        new_vx *= scale
+        new_vy *= scale
+
+    # Move the boid according to its new velocity.
+    out_pos[i, 0] = x + new_vx
+    out_pos[i, 1] = y + new_vy
+    out_vel[i, 0] = new_vx
+    out_vel[i, 1] = new_vy
+
+
+def step(
+    pos: np.ndarray,
+    vel: np.ndarray,
+    sight_range_sq: float,
+    min_separation_sq: float,
+    alignment: float,
+    cohesion: float,
+    separation: float,
+    max_speed: float,
+    boundary_force: float,
+    half_width: float,
+    half_height: float,
+    target_pos: np.ndarray,
+    target_start: np.ndarray,
+    target_affinity: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Apply the alignment, cohesion, separation and affinity rules to
+    every boid on the GPU, limit their speed and keep them within the
+    window, then move them. Return the new positions and velocities.
+
+    The arguments match `_kernels.step()`, except there are no grids and
+    the target flocks are located by their start offsets: flock `t`
+    occupies the rows of `target_pos` from `target_start[t]` to
+    `target_start[t + 1]`."""
+
+    n = pos.shape[0]
+    if n == 0:
+        return (np.empty_like(pos), np.empty_like(vel))
+
+    d_pos = cuda.to_device(pos)
+    d_vel = cuda.to_device(vel)
+    d_out_pos = cuda.device_array_like(pos)
+    d_out_vel = cuda.device_array_like(vel)
+
+    blocks = (n + THREADS_PER_BLOCK - 1) // THREADS_PER_BLOCK
+    _step_kernel[blocks, THREADS_PER_BLOCK](
+        d_pos,
+        d_vel,
+        d_out_pos,
+        d_out_vel,
+        sight_range_sq,
+        min_separation_sq,
+        alignment,
+        cohesion,
+        separation,
+        max_speed,
+        boundary_force,
+        half_width,
+        half_height,
+        cuda.to_device(target_pos),
+        cuda.to_device(target_start),
+        cuda.to_device(target_affinity),
+    )
+
+    return (d_out_pos.copy_to_host(), d_out_vel.copy_to_host())
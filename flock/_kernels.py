@@ -0,0 +1,351 @@
+"""Compiled kernels for applying the movement rules to a flock."""
+
+import math
+
+import numpy as np
+from numba import float32, float64, int64, njit, prange, types
+
+# The types of the kernel arguments. Declaring them compiles the kernels
+# when this module is imported instead of on the first tick, and the
+# C-contiguous array layouts ("::1") let the compiler vectorize the loops.
+# Positions and velocities are single precision, which halves the memory
+# read by the neighbor search and doubles the values per vector register.
+_points = float32[:, ::1]
+_indices = int64[::1]
+_grid = types.Tuple(
+    (_indices, _indices, float64, float64, float64, int64, int64)
+)
+
+
+@njit(_grid(_points, float64), cache=True)
+def build_grid(pos, radius):
+    """Sort the points in the (n, 2) array `pos` into a uniform grid of
+    square cells at least `radius` wide, so every point within `radius`
+    of a location lies in the location's cell or one of the 8 cells
+    around it.
+
+    Return a tuple of `(order, cell_start, origin_x, origin_y, cell_size,
+    cols, rows)`. The indices of the points in cell `c` are
+    `order[cell_start[c]:cell_start[c + 1]]`, where cell `c` is at column
+    `c % cols` and row `c // cols` counting from the origin."""
+
+    n = pos.shape[0]
+    if n == 0:
+        return (
+            np.empty(0, np.int64),
+            np.zeros(1, np.int64),
+            0.0,
+            0.0,
+            1.0,
+            0,
+            0,
+        )
+
+    min_x = float(pos[:, 0].min())
+    min_y = float(pos[:, 1].min())
+    width = pos[:, 0].max() - min_x
+    height = pos[:, 1].max() - min_y
+
+    # Widen the cells if boids are scattered so far apart that the grid
+    # would have many more cells than boids.
+    max_cells = 4 * n + 16
+    cell_size = max(radius, 1.0)
+    cols = int(width / cell_size) + 1
+    rows = int(height / cell_size) + 1
+    while cols * rows > max_cells:
+        cell_size *= 2
+        cols = int(width / cell_size) + 1
+        rows = int(height / cell_size) + 1
+
+    # Counting sort the points by cell.
+    cell = np.empty(n, np.int64)
+    cell_start = np.zeros(cols * rows + 1, np.int64)
+    for i in range(n):
+        cx = int((pos[i, 0] - min_x) / cell_size)
+        cy = int((pos[i, 1] - min_y) / cell_size)
+        cell[i] = cy * cols + cx
+        cell_start[cell[i] + 1] += 1
+
+    for c in range(cols * rows):
+        cell_start[c + 1] += cell_start[c]
+
+    order = np.empty(n, np.int64)
+    fill = cell_start[:-1].copy()
+    for i in range(n):
+        order[fill[cell[i]]] = i
+        fill[cell[i]] += 1
+
+    return (order, cell_start, min_x, min_y, cell_size, cols, rows)
+
+
+@njit(types.UniTuple(int64, 2)(_grid, float64, float64), cache=True)
+def _cell_of(grid, x, y):
+    """Return the `(col, row)` of the grid cell containing the location.
+    The cell may be outside of the grid."""
+
+    _, _, origin_x, origin_y, cell_size, _, _ = grid
+    return (
+        int(math.floor((x - origin_x) / cell_size)),
+        int(math.floor((y - origin_y) / cell_size)),
+    )
+
+
+@njit(float64(_grid, int64, int64, float64, float64), cache=True)
+def _cell_dist_sq(grid, col, row, x, y):
+    """Return the squared distance from the location to the closest point
+    of the grid cell."""
+
+    _, _, origin_x, origin_y, cell_size, _, _ = grid
+    left = origin_x + col * cell_size
+    top = origin_y + row * cell_size
+    dx = max(left - x, 0.0, x - (left + cell_size))
+    dy = max(top - y, 0.0, y - (top + cell_size))
+    return dx * dx + dy * dy
+
+
+@njit(types.UniTuple(int64, 4)(_grid, float64, float64), cache=True)
+def _cell_range(grid, x, y):
+    """Return the `(col_start, col_end, row_start, row_end)` bounds of the
+    grid cells around the location, clipped to the grid. The bounds are
+    empty if the location is not next to the grid."""
+
+    _, _, _, _, _, cols, rows = grid
+    cx, cy = _cell_of(grid, x, y)
+    return (
+        min(max(cx - 1, 0), cols),
+        min(max(cx + 2, 0), cols),
+        min(max(cy - 1, 0), rows),
+        min(max(cy + 2, 0), rows),
+    )
+
+
+@njit(
+    types.void(
+        _points,
+        _points,
+        _points,
+        _points,
+        _grid,
+        float32,
+        float32,
+        float64,
+        float64,
+        float64,
+        float64,
+        float64,
+        float64,
+        float64,
+        _points,
+        _indices,
+        _grid,
+        float64[::1],
+    ),
+    parallel=True,
+    fastmath=True,
+    cache=True,
+)
+def step(
+    pos,
+    vel,
+    out_pos,
+    out_vel,
+    grid,
+    sight_range_sq,
+    min_separation_sq,
+    alignment,
+    cohesion,
+    separation,
+    max_speed,
+    boundary_force,
+    half_width,
+    half_height,
+    target_pos,
+    target_flock,
+    target_grid,
+    target_affinity,
+):
+    """Apply the alignment, cohesion, separation and affinity rules to
+    every boid, limit their speed and keep them within the window, then
+    move them.
+
+    `pos` and `vel` are (n, 2) arrays of the flock's positions and
+    velocities at the start of the tick, and the new positions and
+    velocities are written to `out_pos` and `out_vel`. The window is
+    centered on the origin and `half_width` by `half_height` in each
+    direction.
+
+    `grid` is the result of `build_grid()` for `pos`, with cells at least
+    as wide as the sight range and minimum separation. The boids are
+    copied into cell order before searching, so the boids in a row of
+    neighboring cells are contiguous in memory.
+
+    The flocks this flock has an affinity toward are concatenated in
+    `target_pos`, where row `j` belongs to flock `target_flock[j]` with
+    the affinity value `target_affinity[target_flock[j]]`. `target_grid`
+    is the result of `build_grid()` for `target_pos`, with cells at least
+    as wide as the sight range."""
+
+    n = pos.shape[0]
+    order, cell_start, _, _, _, cols, _ = grid
+    target_order, target_cell_start, _, _, _, target_cols, target_rows = (
+        target_grid
+    )
+    num_targets = target_affinity.shape[0]
+
+    # Gather the boids into cell order.
+    sorted_pos = np.empty_like(pos)
+    sorted_vel = np.empty_like(vel)
+    for s in prange(n):
+        sorted_pos[s] = pos[order[s]]
+        sorted_vel[s] = vel[order[s]]
+
+    num_target_boids = target_pos.shape[0]
+    sorted_target_pos = np.empty_like(target_pos)
+    sorted_target_flock = np.empty_like(target_flock)
+    for s in prange(num_target_boids):
+        sorted_target_pos[s] = target_pos[target_order[s]]
+        sorted_target_flock[s] = target_flock[target_order[s]]
+
+    # The closest boid found in each target flock and its squared distance,
+    # for every boid. These are allocated once rather than per boid to keep
+    # allocations out of the parallel loop.
+    closest = np.empty((n, num_targets), np.int64)
+    closest_dist_sq = np.empty((n, num_targets), np.float32)
+
+    for s in prange(n):
+        i = order[s]
+        x = sorted_pos[s, 0]
+        y = sorted_pos[s, 1]
+        vx = sorted_vel[s, 0]
+        vy = sorted_vel[s, 1]
+
+        sum_vx = 0.0
+        sum_vy = 0.0
+        sum_x = 0.0
+        sum_y = 0.0
+        num_neighbors = 0
+        sep_x = 0.0
+        sep_y = 0.0
+
+        # Accumulate the values for every rule in a single pass over the
+        # other boids in the surrounding grid cells. The cells in each row
+        # are adjacent, so their boids are one contiguous range.
+        col_start, col_end, row_start, row_end = _cell_range(grid, x, y)
+        for row in range(row_start, row_end):
+            start = cell_start[row * cols + col_start]
+            end = cell_start[row * cols + col_end]
+            for j in range(start, end):
+                if j == s:
+                    continue
+
+                dx = sorted_pos[j, 0] - x
+                dy = sorted_pos[j, 1] - y
+                dist_sq = dx * dx + dy * dy
+
+                if dist_sq <= sight_range_sq:
+                    sum_vx += sorted_vel[j, 0]
+                    sum_vy += sorted_vel[j, 1]
+                    sum_x += sorted_pos[j, 0]
+                    sum_y += sorted_pos[j, 1]
+                    num_neighbors += 1
+
+                if dist_sq < min_separation_sq:
+                    sep_x -= dx
+                    sep_y -= dy
+
+        # Align the boid's velocity with the sum of the neighbor velocities.
+        new_vx = vx + (sum_vx - vx) * alignment
+        new_vy = vy + (sum_vy - vy) * alignment
+
+        # Steer the boid towards the center of its neighbors, if it has any.
+        if num_neighbors > 0:
+            new_vx += (sum_x / num_neighbors - x) * cohesion
+            new_vy += (sum_y / num_neighbors - y) * cohesion
+
+        # Steer the boid away from the neighbors that are too close.
+        new_vx += sep_x * separation
+        new_vy += sep_y * separation
+
+        # Pursue or flee from the closest boid in each target flock, but
+        # only if the boid can see it. Any boid within the sight range is
+        # in the boid's cell or the 8 cells around it. The boid's own cell
+        # is searched first, then the surrounding cells are skipped if
+        # they are too far away to hold a boid in sight that is closer
+        # than the ones already found. Ties go to the boid that comes
+        # first in the target flock.
+        for t in range(num_targets):
+            closest[s, t] = -1
+            closest_dist_sq[s, t] = sight_range_sq
+        cx, cy = _cell_of(target_grid, x, y)
+        for k in range(9):
+            # Map k = 0 to the center cell and k = 1 to 8 to the others.
+            c = (k + 4) % 9
+            col = cx + c % 3 - 1
+            row = cy + c // 3 - 1
+            if col < 0 or col >= target_cols or row < 0 or row >= target_rows:
+                continue
+
+            farthest_dist_sq = 0.0
+            for t in range(num_targets):
+                farthest_dist_sq = max(farthest_dist_sq, closest_dist_sq[s, t])
+            if _cell_dist_sq(target_grid, col, row, x, y) > farthest_dist_sq:
+                continue
+
+            cell = row * target_cols + col
+            start = target_cell_start[cell]
+            end = target_cell_start[cell + 1]
+            for j in range(start, end):
+                dx = sorted_target_pos[j, 0] - x
+                dy = sorted_target_pos[j, 1] - y
+                dist_sq = dx * dx + dy * dy
+                t = sorted_target_flock[j]
+                if dist_sq > closest_dist_sq[s, t]:
+                    continue
+                if (
+                    closest[s, t] < 0
+                    or dist_sq < closest_dist_sq[s, t]
+                    or target_order[j] < target_order[closest[s, t]]
+                ):
+                    closest[s, t] = j
+                    closest_dist_sq[s, t] = dist_sq
+
+        for t in range(num_targets):
+            j = closest[s, t]
+            if j >= 0:
+                new_vx += (sorted_target_pos[j, 0] - x) * target_affinity[t]
+                new_vy += (sorted_target_pos[j, 1] - y) * target_affinity[t]
+
+        # If the boid is too fast, set the speed to the max speed but
+        # preserve the direction.
+        speed = math.hypot(new_vx, new_vy)
+        if speed > max_speed:
+            new_vx = new_vx / speed * max_speed
+            new_vy = new_vy / speed * max_speed
+
+        # Turn the boid back if it strays outside the window, which spans
+        # from -half_width to half_width and -half_height to half_height.
+        magnitude_sq = new_vx * new_vx + new_vy * new_vy
+
+        if x < -half_width:
+            new_vx += boundary_force
+        elif x > half_width:
+            new_vx -= boundary_force
+
+        if y < -half_height:
+            new_vy += boundary_force
+        elif y > half_height:
+            new_vy -= boundary_force
+
+        # If the velocity correction made the boid speed up, set the speed
+        # to the previous value while keeping the new direction.
+        new_magnitude_sq = new_vx * new_vx + new_vy * new_vy
+        if new_magnitude_sq > magnitude_sq:
+            scale = math.sqrt(magnitude_sq / new_magnitude_sq)
+            new_vx *= scale
+            new_vy *= scale
+
+        # Move the boid according to its new velocity.
+        out_pos[i, 0] = x + new_vx
+        out_pos[i, 1] = y + new_vy
+        out_vel[i, 0] = new_vx
+        out_vel[i, 1] = new_vy
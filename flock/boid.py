@@ -1,61 +1,62 @@
-import math
-import random
-
-from typing_extensions import Self
+import numpy as np
 
 
 class Boid:
-    """A class to simulate a boid and keep track of its position and
-    velocity."""
-
-    def __init__(
-        self,
-        flock,
-        x: float,
-        y: float,
-        vx: float,
-        vy: float,
-    ) -> None:
+    """A view of a single boid in a flock.
+
+    The position and velocity are stored in the flock's arrays so the
+    movement rules can be applied to the whole flock at once. This class
+    provides access to one row of those arrays."""
+
+    __slots__ = ("flock", "index")
+
+    def __init__(self, flock, index: int) -> None:
         self.flock = flock
-        self.x = x
-        self.y = y
-        self.vx = vx
-        self.vy = vy
+        self.index = index
+
+    @property
+    def x(self) -> float:
+        return float(self.flock.pos[self.index, 0])
+
+    @x.setter
+    def x(self, value: float) -> None:
+        self.flock.pos[self.index, 0] = value
+
+    @property
+    def y(self) -> float:
+        return float(self.flock.pos[self.index, 1])
 
-        self.pos_history = []
+    @y.setter
+    def y(self, value: float) -> None:
+        self.flock.pos[self.index, 1] = value
 
-    def update_position(self) -> None:
-        self.pos_history.append((self.x, self.y))
-        if len(self.pos_history) > self.flock.tracer_len:
-            self.pos_history.pop(0)
+    @property
+    def vx(self) -> float:
+        return float(self.flock.vel[self.index, 0])
 
-        self.x += self.vx
-        self.y += self.vy
+    @vx.setter
+    def vx(self, value: float) -> None:
+        self.flock.vel[self.index, 0] = value
 
-    @classmethod
-    def create_random(
-        cls: type[Self],
-        flock,
-        min_position: tuple[float, float],
-        max_position: tuple[float, float],
-        min_velocity: float,
-        max_velocity: float,
-    ):
-        """Create and return a boid with a random position and velocity."""
+    @property
+    def vy(self) -> float:
+        return float(self.flock.vel[self.index, 1])
 
-        x = random.uniform(min_position[0], max_position[0])
-        y = random.uniform(min_position[1], max_position[1])
+    @vy.setter
+    def vy(self, value: float) -> None:
+        self.flock.vel[self.index, 1] = value
 
-        vx = random.uniform(min_velocity, max_velocity)
-        vy = random.uniform(min_velocity, max_velocity)
+    @property
+    def pos_history(self) -> np.ndarray:
+        """The previous positions of the boid for the tracer, from oldest
+        to newest."""
 
-        return cls(flock, x, y, vx, vy)
+        return self.flock.get_history(self.index)
 
     def in_range(self, other: "Boid") -> bool:
         """Return whether the other boid is within this boid's range of
         sight."""
 
-        return (
-            math.dist((self.x, self.y), (other.x, other.y))
-            <= self.flock.sight_range
-        )
+        dx = self.x - other.x
+        dy = self.y - other.y
+        return dx * dx + dy * dy <= self.flock.sight_range_sq
@@ -1,8 +1,9 @@
-import math
 from typing import Any
 from typing_extensions import Self
 
+import numpy as np
 
+from . import _cuda, _kernels
 from .boid import Boid
 from .color import ColorType, lighten
 
@@ -61,6 +62,7 @@ class Flock:
 
         # The minimum distance between the boid and its neighbors.
         self.min_separation = min_separation
+        self.min_separation_sq = np.float32(min_separation * min_separation)
 
         # The maximum possible velocity for the boid.
         self.max_speed = max_speed
@@ -75,6 +77,7 @@ class Flock:
         # determine its movement patterns, including pursuing/fleeing other
         # flocks.
         self.sight_range = sight_range
+        self.sight_range_sq = np.float32(sight_range * sight_range)
 
         # The RGB color value of the boid.
         self.color = color
@@ -90,37 +93,134 @@ class Flock:
         # Whether to display the tracer.
         self.tracer_enabled = tracer_enabled
 
-        # Initialize a list of boids with random position and velocity.
-        dimensions = (self.simulation.width / 2, self.simulation.height / 2)
+        # The boid and tracer colors mapped to pixel values of the window,
+        # so they can be drawn without converting the RGB values each time.
+        self.pixel_color = self.simulation.window.map_rgb(self.color)
+        self.tracer_pixel_color = self.simulation.window.map_rgb(
+            self.tracer_color
+        )
+
+        # Initialize the boids with random position and velocity. The
+        # positions and velocities are stored as (num_boids, 2) arrays of
+        # (x, y) pairs so the rules can be applied to every boid at once.
+        # Single precision is plenty for screen coordinates.
+        dimensions = (self.simulation.half_width, self.simulation.half_height)
         min_velocity = -1
         max_velocity = 1
-        self.boids: list[Boid] = [
-            Boid.create_random(
-                self,
-                (0, 0),
-                dimensions,
-                min_velocity,
-                max_velocity,
+        rng = np.random.default_rng()
+        self.pos = rng.uniform(
+            (0, 0), dimensions, size=(num_boids, 2)
+        ).astype(np.float32)
+        self.vel = rng.uniform(
+            min_velocity, max_velocity, size=(num_boids, 2)
+        ).astype(np.float32)
+
+        self.boids: list[Boid] = [Boid(self, i) for i in range(num_boids)]
+
+        # The previous positions of the boids for the tracers, stored as a
+        # ring buffer of `tracer_len` position arrays. The next positions
+        # are written at the cursor, overwriting the oldest ones once the
+        # buffer is full.
+        self._history = np.empty((tracer_len, num_boids, 2), np.float32)
+        self._history_cursor = 0
+        self._history_count = 0
+
+    def update(self) -> None:
+        """Apply the behavior rules to every boid then update their
+        positions."""
+
+        # Gather the positions of the flocks this flock has an affinity
+        # toward, so the closest boid in each of them can be found.
+        targets = [flock for flock, _ in self.affinity_flocks]
+        target_sizes = [flock.num_boids for flock in targets]
+        target_pos = np.concatenate(
+            [flock.pos for flock in targets] + [np.empty((0, 2), np.float32)]
+        )
+
+        # Every boid is updated from the positions and velocities at the
+        # start of the tick, so the new values are written to separate
+        # arrays. The kernels apply every rule, the speed limit and the
+        # bounds check, then move the boids, all in a single pass.
+        if self.simulation.device == "cuda":
+            new_pos, new_vel = _cuda.step(
+                self.pos,
+                self.vel,
+                self.sight_range_sq,
+                self.min_separation_sq,
+                self.alignment,
+                self.cohesion,
+                self.separation,
+                self.max_speed,
+                self.boundary_force,
+                self.simulation.half_width,
+                self.simulation.half_height,
+                target_pos,
+                np.cumsum([0] + target_sizes, dtype=np.int64),
+                self._target_affinity,
+            )
+        else:
+            # Sort the target boids into a grid, so only the cells around
+            # each boid need to be searched.
+            target_flock = np.repeat(
+                np.arange(len(targets), dtype=np.int64), target_sizes
+            )
+            target_grid = _kernels.build_grid(
+                target_pos, float(self.sight_range)
+            )
+            self._rebuild_grid()
+
+            new_pos = np.empty_like(self.pos)
+            new_vel = np.empty_like(self.vel)
+            _kernels.step(
+                self.pos,
+                self.vel,
+                new_pos,
+                new_vel,
+                self._grid,
+                self.sight_range_sq,
+                self.min_separation_sq,
+                self.alignment,
+                self.cohesion,
+                self.separation,
+                self.max_speed,
+                self.boundary_force,
+                self.simulation.half_width,
+                self.simulation.half_height,
+                target_pos,
+                target_flock,
+                target_grid,
+                self._target_affinity,
             )
-            for _ in range(num_boids)
-        ]
 
-    def update_boid(self, boid: Boid) -> None:
-        """Apply the behavior rules to the boid then update its position."""
+        # Record the previous positions for the tracers.
+        if self.tracer_len > 0:
+            self._history[self._history_cursor] = self.pos
+            self._history_cursor = (self._history_cursor + 1) % self.tracer_len
+            self._history_count = min(self._history_count + 1, self.tracer_len)
 
-        # Calculate alignment first, because the other rules modify the
-        # velocity which is used in these calculations.
-        self.rule_alignment(boid)
-        self.rule_cohesion(boid)
-        self.rule_separation(boid)
-        self.rule_affinity(boid)
+        self.pos = new_pos
+        self.vel = new_vel
 
-        # Perform speed and bounds checks.
-        self.limit_speed(boid)
-        self.keep_in_bounds(boid)
+    def resolve_affinity(self) -> None:
+        """Look up the flocks in the affinity list by their IDs. This must
+        be called once every flock in the simulation has been created."""
 
-        # Move the boid according to its new velocity.
-        boid.update_position()
+        self.affinity_flocks: list[tuple[Flock, float]] = [
+            (self.simulation.get_flock(flock_id), affinity)
+            for flock_id, affinity in self.affinity
+        ]
+        self._target_affinity = np.array(
+            [affinity for _, affinity in self.affinity], dtype=np.float64
+        )
+
+    def _rebuild_grid(self) -> None:
+        """Sort the boids into a grid of cells as wide as the range of
+        sight, so only the boids in the surrounding cells need to be
+        checked when searching for neighbors."""
+
+        self._grid = _kernels.build_grid(
+            self.pos, float(max(self.sight_range, self.min_separation))
+        )
 
     @classmethod
     def from_config(cls, simulation, config: dict[str, Any]) -> Self:
@@ -147,152 +247,28 @@ class Flock:
             config["tracer"]["enabled"],
         )
 
-    def rule_affinity(self, boid: Boid) -> None:
-        """If this flock has a positive or negative affinity toward another
-        flock, move the boid toward or away from the closest boid in that
-        flock."""
-
-        for flock_id, affinity in self.affinity:
-            # Lookup the flock by its ID.
-            flock: Flock = self.simulation.get_flock(flock_id)
-
-            # Find the closest boid in the other flock using the distance
-            # as a comparison key.
-            closest = min(
-                flock.boids,
-                key=lambda other: math.dist(
-                    (boid.x, boid.y), (other.x, other.y)
-                ),
-            )
-
-            # Only pursue/flee if the boid can see the other boid.
-            if boid.in_range(closest):
-                boid.vx += (closest.x - boid.x) * affinity
-                boid.vy += (closest.y - boid.y) * affinity
-
-    def rule_alignment(self, boid: Boid) -> None:
-        """Align the boid's velocity with the other boids in the flock."""
-
-        avg_vx = 0.0
-        avg_vy = 0.0
-
-        # Take the average of the neighboring boid's velocity.
-        for other in self.boids:
-            if boid is not other and boid.in_range(other):
-                avg_vx += other.vx
-                avg_vy += other.vy
-
-        # Modify the boid's velocity based on the average neighbor velocity
-        # and the flock's alignment value.
-        avg_vx = (avg_vx - boid.vx) * self.alignment
-        avg_vy = (avg_vy - boid.vy) * self.alignment
-        boid.vx += avg_vx
-        boid.vy += avg_vy
-
-    def rule_separation(self, boid: Boid) -> None:
-        """Make the boid avoid other boids in the flock that get too close."""
-
-        vx = 0.0
-        vy = 0.0
-
-        # Steer the boid away from every neighboring boid that is too close.
-        for other in self.boids:
-            if other != boid:
-                if (
-                    math.dist((boid.x, boid.y), (other.x, other.y))
-                    < self.min_separation
-                ):
-                    vx += boid.x - other.x
-                    vy += boid.y - other.y
-
-        # Modify the boid's velocity based on the calculated change and the
-        # flock's alignment value.
-        boid.vx += vx * self.separation
-        boid.vy += vy * self.separation
-
-    def rule_cohesion(self, boid: Boid) -> None:
-        """Point the boid's velocity toward the center of the other boids
-        in the flock within its line of sight."""
-
-        center_x = 0.0
-        center_y = 0.0
-        # Count the number of neighbors to use in the average calculation.
-        num_neighbors = 0
-
-        # Calculate the average position of the neighboring boids.
-        for other in self.boids:
-            if boid is not other and boid.in_range(other):
-                center_x += other.x
-                center_y += other.y
-                num_neighbors += 1
-
-        # If there are no neighbors, no adjustment needs to be made.
-        if num_neighbors == 0:
-            return
-
-        center_x /= num_neighbors
-        center_y /= num_neighbors
-
-        # Modify the boid's velocity to steer it towards the center of the
-        # flock.
-        boid.vx += (center_x - boid.x) * self.cohesion
-        boid.vy += (center_y - boid.y) * self.cohesion
-
-    def limit_speed(self, boid: Boid) -> None:
-        """Limit the boid's speed to a maximum value."""
-
-        # If the boid is too fast, set the speed to the max speed but
-        # preserve the direction.
-        speed = math.hypot(boid.vx, boid.vy)
-        if speed > self.max_speed:
-            boid.vx = (boid.vx / speed) * self.max_speed
-            boid.vy = (boid.vy / speed) * self.max_speed
-
-    def keep_in_bounds(self, boid: Boid) -> None:
-        """Keep the boid within the window, turning it back if it strays
-        outside."""
-
-        # Convert the coordinates to absolute so they can be compared with
-        # the window boundaries.
-        x, y = self.simulation.absolute_coords((boid.x, boid.y))
-
-        magnitude = math.hypot(boid.vx, boid.vy)
-
-        if x < 0:
-            boid.vx += self.boundary_force
-        elif x > self.simulation.width:
-            boid.vx -= self.boundary_force
-
-        if y < 0:
-            boid.vy += self.boundary_force
-        elif y > self.simulation.height:
-            boid.vy -= self.boundary_force
-
-        # If the velocity correction made the boid speed up, set the speed
-        # to the previous value while keeping the new direction.
-        new_magnitude = math.hypot(boid.vx, boid.vy)
-        if new_magnitude > magnitude:
-            boid.vx, boid.vy = _set_magnitude((boid.vx, boid.vy), magnitude)
-
     def get_center(self) -> tuple[float, float]:
         """Return the (x, y) coordinates of the center of the flock."""
 
-        x = sum(boid.x for boid in self.boids) / len(self.boids)
-        y = sum(boid.y for boid in self.boids) / len(self.boids)
-        return (x, y)
+        x, y = self.pos.mean(axis=0)
+        return (float(x), float(y))
 
+    def get_history(self, index: int | None = None) -> np.ndarray:
+        """Return the previous positions of the boids for the tracers as a
+        (length, num_boids, 2) array, from oldest to newest. If `index` is
+        given, return only the positions of that boid as a (length, 2)
+        array."""
 
-def _set_magnitude(
-    v: tuple[float, float], magnitude: float
-) -> tuple[float, float]:
-    """Return a new vector with the same direction as `v`, but with the
-    given magnitude."""
+        if self._history_count == 0:
+            history = self._history[:0]
+            return history if index is None else history[:, index]
 
-    x, y = v
+        # Select the slots of the ring buffer that have been written, from
+        # the oldest to the newest, reading only the one boid if given.
+        slots = (
+            np.arange(-self._history_count, 0) + self._history_cursor
+        ) % self.tracer_len
+        if index is None:
+            return self._history[slots]
+        return self._history[slots, index]
 
-    current_magnitude = math.sqrt(x**2 + y**2)
-    if current_magnitude == 0:
-        return (0, 0)
-    else:
-        scale_factor = magnitude / current_magnitude
-        return (x * scale_factor, y * scale_factor)
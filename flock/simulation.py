@@ -1,15 +1,20 @@
 import sys
-import time
 from typing import Any
 
 from typing_extensions import Self
 
+import numpy as np
 import pygame
 
-from .boid import Boid
 from .flock import Flock
 from .color import ColorType
 
+# The maximum number of frames drawn per second.
+FRAME_RATE = 60
+
+# The Pygame events handled by the simulation.
+HANDLED_EVENTS = [pygame.QUIT, pygame.VIDEORESIZE]
+
 
 class Simulation:
     """A class to manage the Pygame interface and flocks of boids."""
@@ -20,18 +25,51 @@ class Simulation:
         window_size: tuple[int, int],
         background_color: ColorType,
         step_length: float,
+        device: str = "cpu",
     ) -> None:
         self.width, self.height = window_size
+        self.half_width = self.width / 2
+        self.half_height = self.height / 2
         self.background_color = background_color
         self.step_length = step_length
 
-        self.window = pygame.display.set_mode(window_size, pygame.RESIZABLE)
+        if device not in ("cpu", "cuda"):
+            raise ValueError(
+                f'Unknown device "{device}", expected "cpu" or "cuda".'
+            )
+        self.device = device
+
+        self.window = pygame.display.set_mode(
+            window_size, pygame.RESIZABLE | pygame.DOUBLEBUF
+        )
         pygame.display.set_caption("Flock Simulator")
 
+        # Only queue the events that are handled, so SDL discards the rest
+        # before they reach Python.
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(HANDLED_EVENTS)
+
+        # The pixel offsets covering a disc around the center of a boid,
+        # used to draw every boid in a flock at once.
+        entity_size = 3
+        offsets = np.arange(-entity_size, entity_size + 1)
+        dx, dy = np.meshgrid(offsets, offsets)
+        in_disc = dx * dx + dy * dy <= entity_size * entity_size
+        self._entity_dx = dx[in_disc]
+        self._entity_dy = dy[in_disc]
+
         # Initialize the list of flocks from a list of configuration dicts.
         self.flocks = [
             Flock.from_config(self, conf) for conf in flock_config
         ]
+        self._flocks_by_id = {
+            flock.id: flock for flock in self.flocks if flock.id is not None
+        }
+
+        # Now that every flock exists, resolve the IDs in their affinity
+        # lists.
+        for flock in self.flocks:
+            flock.resolve_affinity()
 
     @classmethod
     def from_config(cls, config: dict) -> Self:
@@ -46,8 +84,11 @@ class Simulation:
         background_color = config["window"]["background_color"]
 
         step_length = config["simulation"]["step_length"]
+        device = config["simulation"].get("device", "cpu")
 
-        return cls(flock_config, window_size, background_color, step_length)
+        return cls(
+            flock_config, window_size, background_color, step_length, device
+        )
 
     def absolute_coords(
         self, point: tuple[float, float]
@@ -55,72 +96,106 @@ class Simulation:
         """Convert the coordinate from relative to the center of the window
         to absolute, so that (0, 0) is at the center of the window."""
 
-        return (point[0] + self.width / 2, point[1] + self.height / 2)
-
-    def draw_tracer(self, boid: Boid) -> None:
-        """Draw a tracer behind the boid on the window without updating the
-        display."""
+        return (point[0] + self.half_width, point[1] + self.half_height)
 
-        # Convert the points in the boid's position history to their
-        # absolute position.
-        absolute_points = [
-            self.absolute_coords(point) for point in boid.pos_history
-        ]
+    def draw_tracers(self, flock: Flock) -> None:
+        """Draw a tracer behind each boid in the flock on the window
+        without updating the display."""
 
-        # Only draw the tracer if there are at least two points in the
+        # Only draw the tracers if there are at least two points in the
         # history.
-        if len(absolute_points) > 2:
-            pygame.draw.lines(
-                self.window,
-                boid.flock.tracer_color,
-                False,
-                absolute_points,
-            )
+        history = flock.get_history()
+        if len(history) <= 2:
+            return
 
-    def draw_entity(self, boid: Boid) -> None:
-        """Draw the boid on the window without updating the display."""
+        # Convert the points in the position history to their absolute
+        # position, all at once. This also converts them from single to
+        # double precision, which pygame.draw.lines() requires.
+        absolute_points = history + (self.half_width, self.half_height)
 
-        entity_size = 3
-        # Convert the position of the entity to absolute.
-        pos = self.absolute_coords((boid.x, boid.y))
-        pygame.draw.circle(self.window, boid.flock.color, pos, entity_size)
+        color = flock.tracer_pixel_color
+        for points in absolute_points.swapaxes(0, 1):
+            pygame.draw.lines(self.window, color, False, points)
 
-    def run(self) -> None:
-        """Run the simulation."""
+    def draw_entities(self) -> None:
+        """Draw the boids of every flock on the window without updating the
+        display.
 
-        while True:
-            # Keep track of the time at each tick for time normalization
-            # purposes.
-            current_time = time.time()
+        The boids are written directly into the window's pixel array, so
+        each flock is drawn with a few array operations instead of one
+        draw call per boid."""
 
-            self.window.fill(self.background_color)
+        # Lock the window surface and get a (width, height) view of its
+        # pixel values.
+        pixels = pygame.surfarray.pixels2d(self.window)
+        width, height = pixels.shape
 
-            # Draw the tracers first so they appear beneath the boids.
-            for flock in self.flocks:
-                if not flock.tracer_enabled:
-                    continue
-                for boid in flock.boids:
-                    self.draw_tracer(boid)
+        for flock in self.flocks:
+            # Convert the positions of the entities to absolute, then
+            # offset them to cover a disc of pixels around each position.
+            x, y = self.absolute_coords((flock.pos[:, 0], flock.pos[:, 1]))
+            x = np.floor(x).astype(np.intp)[:, np.newaxis] + self._entity_dx
+            y = np.floor(y).astype(np.intp)[:, np.newaxis] + self._entity_dy
+
+            # Skip the pixels outside of the window.
+            visible = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            pixels[x[visible], y[visible]] = flock.pixel_color
+
+        # Release the lock on the window surface.
+        del pixels
+
+    def draw(self) -> None:
+        """Draw the flocks on the window without updating the display."""
 
-            # Draw the boids on top.
-            for flock in self.flocks:
-                for boid in flock.boids:
-                    self.draw_entity(boid)
-                    flock.update_boid(boid)
+        self.window.fill(self.background_color)
+
+        # Draw the tracers first so they appear beneath the boids.
+        for flock in self.flocks:
+            if flock.tracer_enabled:
+                self.draw_tracers(flock)
+
+        # Draw the boids on top.
+        self.draw_entities()
+
+    def run(self) -> None:
+        """Run the simulation."""
+
+        # The simulation is stepped on its own schedule of one step every
+        # `step_length` seconds, while the frames are limited to the frame
+        # rate. This way waiting for the display never delays the steps,
+        # and a frame is only drawn when a step has changed something.
+        clock = pygame.time.Clock()
+        step_ms = self.step_length * 1000
+        frame_ms = 1000 / FRAME_RATE
+        next_step = pygame.time.get_ticks()
+        redraw = True
+
+        while True:
+            # Run every step that is due.
+            frame_start = pygame.time.get_ticks()
+            while pygame.time.get_ticks() >= next_step:
+                for flock in self.flocks:
+                    flock.update()
+                next_step += step_ms
+                redraw = True
+
+                # If the steps can't keep up, drop the backlog and draw a
+                # frame rather than falling further behind.
+                now = pygame.time.get_ticks()
+                if now - frame_start >= frame_ms:
+                    next_step = max(next_step, now)
+                    break
 
             # Only update the display after everything has been drawn.
-            pygame.display.update()
+            if redraw:
+                self.draw()
+                pygame.display.flip()
+                redraw = False
 
-            # After performing the calculations for the tick, sleep for the
-            # rest of the tick. This ensures the simulation doesn't run
-            # too fast in cases of low computational overhead.
-            elapsed_time = time.time() - current_time
-            remaining_sleep = self.step_length - elapsed_time
-            if remaining_sleep > 0:
-                time.sleep(remaining_sleep)
+            clock.tick(FRAME_RATE)
 
             # Handle the Pygame events for resizing the window and quitting.
-            for event in pygame.event.get():
+            for event in pygame.event.get(HANDLED_EVENTS):
                 match event.type:
                     case pygame.QUIT:
                         pygame.quit()
@@ -128,13 +203,15 @@ class Simulation:
                     case pygame.VIDEORESIZE:
                         self.width = event.w
                         self.height = event.h
+                        self.half_width = self.width / 2
+                        self.half_height = self.height / 2
+                        redraw = True
 
     def get_flock(self, id: str) -> Flock:
         """Return the flock with the given id, or raise `KeyError` if
         one does not exist."""
 
-        for flock in self.flocks:
-            if flock.id is not None and flock.id == id:
-                return flock
-
-        raise KeyError(f'No flock exists with id "{id}".')
+        try:
+            return self._flocks_by_id[id]
+        except KeyError:
+            raise KeyError(f'No flock exists with id "{id}".') from None